@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+import math
 import numpy as np
 import re
 
 from enum import auto, Enum
+from numba import njit
 from numpy import ndarray, dtype
 from typing import Callable, NamedTuple, Any, Self
 
@@ -153,55 +155,115 @@ def minor(note):
             note * FIFTH]
 
 # Waveforms
-def sin(t: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
-    """
-    Sine wave
-    """
-    return np.sin(t)
+# Each waveform is compiled into a single loop that computes every sample from t
+# with arithmetic only, no trigonometric calls, and writes it straight into out.
+
+# Constants used by the waveforms, so they multiply by reciprocals rather than divide.
+TWO_PI: float = 2 * math.pi
+HALF_PI: float = math.pi / 2
+INV_PI: float = 1 / math.pi
+INV_TWO_PI: float = 1 / (2 * math.pi)
 
+# Coefficients of an odd degree 7 minimax polynomial for sin on [-pi/2, pi/2].
+SIN_POLY_COEFFICIENTS: tuple[float, float, float, float] = (9.999966159e-01, -1.666482838e-01,
+                                                            8.306325227e-03, -1.836365396e-04)
 
-def square(t: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
+
+@njit(cache=True, fastmath=True)
+def sin_poly(t: np.ndarray[float], out: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
+    """
+    Sine wave approximated by a polynomial, within 1e-6 of the exact sine.
+    """
+    c1, c3, c5, c7 = SIN_POLY_COEFFICIENTS
+    for i in range(t.size):
+        # Reduce t to [-pi, pi], then mirror onto [-pi/2, pi/2] where the polynomial is fitted.
+        x = t[i] - TWO_PI * math.floor(t[i] * INV_TWO_PI + 0.5)
+        if x > HALF_PI:
+            x = math.pi - x
+        elif x < -HALF_PI:
+            x = -math.pi - x
+        x2 = x * x
+        out[i] = x * (c1 + x2 * (c3 + x2 * (c5 + x2 * c7)))
+    return out
+
+
+@njit(cache=True, fastmath=True)
+def square(t: np.ndarray[float], out: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
     """
     Square wave going directly from 1 to -1 and back.
     """
-    return np.where(np.sin(t) > 0, 1.0, -1.0)
+    for i in range(t.size):
+        # The sine is positive on even half periods, so the sign is the parity of t / pi.
+        half_period = int(math.floor(t[i] * INV_PI))
+        out[i] = 1.0 - 2.0 * (half_period & 1)
+    return out
 
 
-def sawtooth(t: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
+@njit(cache=True, fastmath=True)
+def sawtooth(t: np.ndarray[float], out: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
     """
     Sawtooth shaped wave rising linearly from -1 to 1 and wraps
     back to -1
     """
-    return ((t % np.pi) / np.pi - 0.5) * 2
+    for i in range(t.size):
+        # Offset of t from the nearest whole period, in [-0.5, 0.5).
+        period = t[i] * INV_TWO_PI
+        out[i] = 2.0 * (period - math.floor(period + 0.5))
+    return out
 
 
-def triangle(t: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
+@njit(cache=True, fastmath=True)
+def triangle(t: np.ndarray[float], out: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
     """
     Triangle wave going linearly between 1 and -1
     """
-    up_t = ((2 * (t - np.pi / 2)) % (2 * np.pi)) / np.pi - 1
-    down_t = ((-2 * (t - np.pi / 2)) % (2 * np.pi)) / np.pi - 1
-    return np.where(0 < np.cos(t), up_t, down_t)
+    for i in range(t.size):
+        # Offset of t from the nearest whole period, in [-0.5, 0.5).
+        period = t[i] * INV_TWO_PI
+        out[i] = abs(4.0 * (period - math.floor(period + 0.5))) - 1.0
+    return out
+
+
+# Compile the waveforms on import rather than while the first buffer is played.
+for _waveform in (sin_poly, square, sawtooth, triangle):
+    _waveform(np.zeros(1, dtype=np.float32), np.empty(1, dtype=np.float32))
 
-Waveform = Callable[[np.ndarray[float]], ndarray[tuple[Any, ...], dtype[Any]]]
+Waveform = Callable[[np.ndarray[float], np.ndarray[float]], ndarray[tuple[Any, ...], dtype[Any]]]
 
 class Wave(Enum):
-    SIN = auto(), sin
+    SIN = auto(), sin_poly
     SQUARE = auto(), square
     SAWTOOTH = auto(), sawtooth
     TRIANGLE = auto(), triangle
 
     def __init__(self, value, waveform: Waveform):
+        # Small integer tag for storing waveforms in arrays, in order of definition.
+        self.kind: int = value
         self._waveform = waveform
 
-    def __call__(self, t: np.ndarray[float]) -> ndarray[tuple[Any, ...], dtype[Any]]:
-        return self._waveform(t)
+    def __call__(self, t: np.ndarray[float], out: np.ndarray[float] | None = None) -> ndarray[tuple[Any, ...], dtype[Any]]:
+        """
+        Evaluates the waveform at t, writing into out if given.
+        t may have any shape, and is evaluated as a single flat array,
+        so out must be C-contiguous.
+        """
+        # Samples are floats even for integer or list inputs, at least float32.
+        t = np.asarray(t)
+        t = t.astype(np.result_type(t.dtype, np.float32), copy=False)
+        if out is None:
+            out = np.empty(t.shape, dtype=t.dtype)
+        elif not out.flags.c_contiguous:
+            raise ValueError("Waveform output array must be C-contiguous.")
+        elif out.shape != t.shape:
+            raise ValueError(f"Waveform output shape {out.shape} does not match input shape {t.shape}.")
+        self._waveform(np.ascontiguousarray(t).reshape(-1), out.reshape(-1))
+        return out
 
     def __repr__(self):
-        return self._waveform.__name__
+        return self.name.lower()
 
     def __str__(self):
-        return self._waveform.__name__
+        return self.name.lower()
 
     @classmethod
     def from_name(cls, name: str) -> Self:
@@ -1,15 +1,41 @@
 import numpy as np
 import pyaudio as pa
+import threading
+import time
+from dataclasses import dataclass
 from numpy import dtype
-from typing import NamedTuple, Any
+from typing import Iterator, NamedTuple, Self
 
 from file_reader import NoteSheet, ReadNote
-from music_utils import Note, Wave, Waveform
+from music_utils import Note, Wave, TWO_PI
 
 class Sound(NamedTuple):
     note: np.float64
     waveform: Wave
 
+@dataclass
+class ActiveNotes:
+    """
+    The notes queued to be played, as parallel arrays with a row per note.
+    """
+    rows: dict[Sound: int]
+    freqs: np.ndarray[dtype[np.float32]]
+    # Kept in double precision, as they are advanced every buffer for as long as the note plays.
+    phases: np.ndarray[dtype[np.float64]]
+    amplitudes: np.ndarray[dtype[np.float32]]
+    kinds: np.ndarray[dtype[np.int8]]
+
+    @classmethod
+    def of_size(cls, size: int) -> Self:
+        return cls(rows=dict(),
+                   freqs=np.empty(size, dtype=np.float32),
+                   phases=np.empty(size, dtype=np.float64),
+                   amplitudes=np.empty(size, dtype=np.float32),
+                   kinds=np.empty(size, dtype=np.int8))
+
+    def __len__(self):
+        return len(self.rows)
+
 class PlayingNote:
     """
     Encapsulates a note to be played.
@@ -36,17 +62,37 @@ class NotePlayer:
     Holds a PyAudio object and manages how notes are played
     continuously.
     """
+    INITIAL_AMPLITUDE = np.float32(0.1)
+    POLL_TIME = 0.1  # Seconds between checks whether the stream has finished playing.
+
     def __init__(self, sample_freq: int, buffer_size: float):
         self._sample_freq: int = sample_freq
         self._buffer_size: int = int(buffer_size * sample_freq)
         self._buffer_time = self._buffer_size / sample_freq
+        # Each buffer is rendered into this array, which is handed to PyAudio as it is.
+        self._out: np.ndarray[dtype[np.float32]] = np.empty(self._buffer_size, dtype=np.float32)
+        # Rows the waves of the notes are rendered into, grown when more notes play at once.
+        self._scratch: np.ndarray[dtype[np.float32]] = np.empty((0, self._buffer_size), dtype=np.float32)
+        # Sets the notes of each buffer while playing sheet music.
+        self._sheet_music: Iterator[None] | None = None
+        # Raised in the stream callback, kept to be raised again in the thread that started playing.
+        self._callback_error: Exception | None = None
+        # The stream callback renders the queue while it may be changed from other threads.
+        self._queue_lock = threading.Lock()
         self._player: pa.PyAudio = pa.PyAudio()
         self._stream = self._player.open(format=pa.paFloat32,
                                          channels=1,
                                          rate=self._sample_freq,
-                                         output=True)
-        self._notes_queue: dict[Sound: tuple[list[float], float]] = dict()
-        self._base_func: np.ndarray[dtype: np.float32] = 2 * np.pi * np.arange(self._buffer_size)
+                                         output=True,
+                                         frames_per_buffer=self._buffer_size,
+                                         start=False,
+                                         stream_callback=self._stream_callback)
+        self._notes_queue: ActiveNotes = ActiveNotes.of_size(0)
+        # Phase advance of a unit frequency over one buffer, so a note's phase is just base_func * freq.
+        self._base_func: np.ndarray[dtype[np.float32]] = (np.arange(self._buffer_size, dtype=np.float32)
+                                                          * np.float32(TWO_PI / self._sample_freq))
+        # Phase a unit frequency advances by from the start of one buffer to the start of the next.
+        self._buffer_phase: float = TWO_PI * self._buffer_size / self._sample_freq
 
     def __del__(self):
         if self.__getattribute__("_stream"):
@@ -54,60 +100,74 @@ class NotePlayer:
             self._stream.close()
             self._player.terminate()
 
-    def _add_note_to_queue(self, note: Note, waveform: Wave, new_queue: dict[Sound: tuple[float, float]]):
+    def _stream_callback(self, in_data: None, frame_count: int, time_info: dict,
+                         status: int) -> tuple[np.ndarray[dtype[np.float32]] | None, int]:
         """
-        Inserts a note into the queue to be played, and ensures continuity.
+        Renders the next buffer directly into the output buffer handed to the audio device.
         """
-        found_note = False
-        for sound in self._notes_queue.keys():
-            if sound.note == note.freq and sound.waveform == waveform:
-                new_queue[sound] = (self._notes_queue[sound][0][-1] + self._base_func * sound.note / self._sample_freq,
-                                           (self._notes_queue[sound][1] + 1) / 2)
-                found_note = True
-                break
-        if not found_note:
-            key = Sound(note.freq, waveform)
-            new_queue[key] = (self._base_func * note.freq / self._sample_freq, 0.1)
+        try:
+            if self._sheet_music is not None:
+                try:
+                    next(self._sheet_music)
+                except StopIteration:
+                    return None, pa.paComplete
+            return self.export_buffer(out=self._out), pa.paContinue
+        except Exception as error:
+            # PyAudio would only print the error, so keep it and abort the stream instead.
+            self._callback_error = error
+            return None, pa.paAbort
 
-    def set_notes(self, notes: list[Note], waveforms: list[Wave]):
+    def _scratch_rows(self, rows: int) -> np.ndarray[dtype[np.float32]]:
         """
-        Prepare queue of notes to be played.
+        Returns preallocated space for the given number of rows of samples.
         """
-        new_queue: dict[Sound: tuple[list[float], float]] = dict()
-        for note, waveform in zip(notes, waveforms):
-            self._add_note_to_queue(note, waveform, new_queue)
-        self._notes_queue = new_queue
+        if rows > len(self._scratch):
+            self._scratch = np.empty((rows, self._buffer_size), dtype=np.float32)
+        return self._scratch[:rows]
 
-    def _add_sound_to_queue(self, sound: Sound, new_queue: dict[Sound: tuple[float, float]]):
+    def _add_sound_to_queue(self, sound: Sound, row: int, new_queue: ActiveNotes):
         """
-        Inserts a sound into the queue to be played, and ensures continuity.
+        Inserts a sound into a row of the queue to be played, and ensures continuity.
+        A sound that is already playing keeps its phase and amplitude.
         """
-        found_note = False
-        for current_sound in self._notes_queue.keys():
-            if sound.note == current_sound.note and sound.waveform == current_sound.waveform:
-                new_queue[current_sound] = (self._notes_queue[current_sound][0][-1] + self._base_func * sound.note / self._sample_freq,
-                                           (self._notes_queue[current_sound][1] + 1) / 2)
-                found_note = True
-                break
-        if not found_note:
-            new_queue[sound] = (self._base_func * sound.note / self._sample_freq, 0.1)
+        new_queue.rows[sound] = row
+        new_queue.freqs[row] = sound.note
+        new_queue.kinds[row] = sound.waveform.kind
+        previous_row = self._notes_queue.rows.get(sound)
+        if previous_row is not None:
+            new_queue.phases[row] = self._notes_queue.phases[previous_row]
+            new_queue.amplitudes[row] = self._notes_queue.amplitudes[previous_row]
+        else:
+            new_queue.phases[row] = 0.0
+            new_queue.amplitudes[row] = self.INITIAL_AMPLITUDE
 
     def set_sounds(self, sounds: list[Sound]):
         """
         Prepare sound of notes to be played.
         """
-        new_queue: dict[Sound: tuple[list[float], float]] = dict()
-        for sound in sounds:
-            self._add_sound_to_queue(sound, new_queue)
-        self._notes_queue = new_queue
+        # Sort by waveform so that each waveform's notes take up consecutive rows.
+        sounds = sorted(dict.fromkeys(sounds), key=lambda sound: sound.waveform.kind)
+        new_queue = ActiveNotes.of_size(len(sounds))
+        with self._queue_lock:
+            for row, sound in enumerate(sounds):
+                self._add_sound_to_queue(sound, row, new_queue)
+            self._notes_queue = new_queue
+
+    def set_notes(self, notes: list[Note], waveforms: list[Wave]):
+        """
+        Prepare queue of notes to be played.
+        """
+        self.set_sounds([Sound(note.freq, waveform) for note, waveform in zip(notes, waveforms)])
 
     def process_notes(self, notes_to_play: list[ReadNote], beat_time: float, current_notes: list[PlayingNote]) -> list[PlayingNote]:
         """
         Adds bew nodes to the list of notes to play, given a specific beat number.
         """
+        current_sounds: set[Sound] = {playing_note.sound for playing_note in current_notes}
         for note_to_play in notes_to_play:
             note_as_sound: Sound = Sound(note_to_play.note.freq, note_to_play.wave)
-            if note_as_sound not in [read_note.sound for read_note in current_notes]:
+            if note_as_sound not in current_sounds:
+                current_sounds.add(note_as_sound)
                 duration = note_to_play.beats * beat_time
                 new_playing_note: PlayingNote = PlayingNote(sound=note_as_sound,
                                                             duration_in_seconds=duration
@@ -122,20 +182,42 @@ class NotePlayer:
     def play_from_sheet_music(self, note_sheet: NoteSheet):
         """
         Play music directly from NoteSheet object.
+        Each buffer is rendered by the stream callback as the device asks for it.
+        Stops any playback started by play first.
         """
+        self.stop()
+        self._sheet_music = self._sheet_music_steps(note_sheet)
+        self._callback_error = None
+        try:
+            self._stream.start_stream()
+            while self._stream.is_active():
+                time.sleep(self.POLL_TIME)
+        finally:
+            # Stop the stream before clearing the sheet, even when interrupted,
+            # so the callback doesn't go on playing the last notes.
+            self._stream.stop_stream()
+            callback_error = self._callback_error
+            self._sheet_music = None
+            self._callback_error = None
+        if callback_error is not None:
+            raise callback_error
 
+    def _sheet_music_steps(self, note_sheet: NoteSheet) -> Iterator[None]:
+        """
+        Sets the notes of a NoteSheet to play, yielding once per buffer.
+        """
         # Calculate some necessary values
         beat_time = note_sheet.beat_time
         play_time = note_sheet.play_time
         total_samples = self._sample_freq * play_time
         num_buffers = int(total_samples / self._buffer_size)
         self._buffer_time = self._buffer_size / self._sample_freq
+        beats_per_second = 1 / beat_time
         current_time = 0.0
         current_beat: int = 0
 
         current_notes: list[PlayingNote] = list()
         all_notes: list[list[ReadNote]] = note_sheet.get_notes()
-        buffers: list[bytes] = list()
         # Iterate over buffers and add notes according to the given beat number.
         for buffer in range(num_buffers):
             if current_beat > len(all_notes):
@@ -144,40 +226,62 @@ class NotePlayer:
             current_notes = self.process_notes(notes_to_play, beat_time, current_notes)
             current_notes_as_sounds = [note.sound for note in current_notes]
             self.set_sounds(current_notes_as_sounds)
-            new_buffer: bytes = self.export_buffer()
-            buffers.append(new_buffer)
+            yield
             current_time += self._buffer_time
-            current_beat = int(current_time / beat_time)
-
-        self.play_buffers(buffers)
+            current_beat = int(current_time * beats_per_second)
 
-    def export_buffer(self) -> bytes:
+    def export_buffer(self, out: np.ndarray[dtype[np.float32]] | None = None) -> np.ndarray[dtype[np.float32]]:
         """
-        Returns a buffer of bytes to pass on to audio device.
+        Mixes the queued notes into a buffer of samples to pass on to audio device.
+        Writes into out if given, otherwise into a new buffer.
         """
-        component_waves: list[np.ndarray[dtype[np.float32]]] = []
-        sound: Sound
-        note_data: tuple[np.ndarray[float], float]
+        if out is None:
+            out = np.empty(self._buffer_size, dtype=np.float32)
+        with self._queue_lock:
+            self._mix_notes(out)
+        return out
 
-        for sound, note_data in self._notes_queue.items():
-            wave_gen: Waveform = sound.waveform
-            wave: np.ndarray[tuple[Any, ...], dtype[Any]] = wave_gen(note_data[0]) * note_data[1]
-            component_waves.append(wave.astype(np.float32))
-        if component_waves:
-            wave = np.sum(component_waves, axis=0) / len(component_waves)
-        else:
-            wave = np.zeros(self._buffer_size, dtype=np.float32)
+    def _mix_notes(self, out: np.ndarray[dtype[np.float32]]):
+        """
+        Mixes the queued notes into out, then advances them to the start of the next buffer.
+        """
+        notes = self._notes_queue
+        if not len(notes):
+            out.fill(0)
+            return
 
-        return wave.tobytes()
+        # One row of phases per note, turned into that note's samples in place.
+        waves: np.ndarray[dtype[np.float32]] = self._scratch_rows(len(notes))
+        np.multiply.outer(notes.freqs, self._base_func, out=waves)
+        waves += notes.phases[:, None]
+        # Each waveform is evaluated once over the consecutive rows of its notes.
+        start = 0
+        for wave_gen in Wave:
+            stop = int(np.searchsorted(notes.kinds, wave_gen.kind, side='right'))
+            if start < stop:
+                wave_gen(waves[start:stop], out=waves[start:stop])
+            start = stop
+        # Averaging the notes is folded into their amplitudes, a k-length rather than N-length product.
+        amplitudes = notes.amplitudes * np.float32(1.0 / len(notes))
+        # Scale each note by its amplitude and sum them in a single pass, straight into out.
+        np.matmul(amplitudes, waves, out=out)
 
-    def play_buffers(self, buffers: list[bytes]):
-        for buffer in buffers:
-            self._stream.write(buffer)
+        # Continue each note where this buffer ends, and fade it in further towards full amplitude.
+        notes.phases += self._buffer_phase * notes.freqs.astype(np.float64)
+        notes.phases %= TWO_PI
+        notes.amplitudes += 1
+        notes.amplitudes *= 0.5
 
     def play(self):
         """
-        Calculate waveforms for currently playing note and write to
-        the buffer to play them.
+        Start playing the currently set notes, rendering them continuously
+        until stop is called. Does nothing if already playing.
+        """
+        if self._stream.is_stopped():
+            self._stream.start_stream()
+
+    def stop(self):
+        """
+        Stop playing.
         """
-        output_bytes = self.export_buffer()
-        self._stream.write(output_bytes)
+        self._stream.stop_stream()